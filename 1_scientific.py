@@ -2,10 +2,17 @@ import panel as pn
 import pygmt
 import param
 import pandas as pd
+import numpy as np
+
+import lifecycle
+import shared_cache
 
 # Load a panel template
 pn.config.template = "fast"
 
+# Load the plotly extension for the WebGL 3D terrain mode
+pn.extension("plotly")
+
 # Import the bounding box data
 bounding_boxes = pd.read_csv("country-boundingboxes.csv", encoding="latin1")
 
@@ -13,6 +20,23 @@ bounding_boxes = pd.read_csv("country-boundingboxes.csv", encoding="latin1")
 bounding_boxes.set_index('country', inplace=True)
 boxes = bounding_boxes.to_dict(orient='index')
 
+# The starting viewpoint (azimuth and elevation) for both 3D modes
+perspective = [-130, 30]
+
+# The maximum number of points along each side of the mesh sent to the browser in WebGL mode
+mesh_max_points = 250
+
+# The closest plotly colour scales to each GMT colour map, for WebGL mode
+plotly_colour_scales = {
+    "geo": "earth",
+    "relief": "earth",
+    "viridis": "viridis",
+    "ocean": "deep",
+    "topo": "earth",
+    "turbo": "turbo",
+    "jet": "jet",
+}
+
 # Define the map regions (West, East, South and North) for the world and each continent
 # continents = {
 #     "World": [-180, 180, -80, 85],
@@ -47,6 +71,27 @@ class EarthDisplacement(param.Parameterized):
     # Dropdown menu to change the resolution of the images
     resolution = param.ObjectSelector(default="01d", objects=["01d", "30m", "20m", "15m", "10m", "05m", "02m"], label="Resolution")
 
+    # Dropdown menu to choose between the server rendered (GMT) and browser rendered (WebGL) 3D map
+    terrain_mode = param.ObjectSelector(default="GMT", objects=["GMT", "WebGL"], label="3D Mode")
+
+    def __init__(self, **params):
+        super().__init__(**params)
+
+        # Keep one pane for each map and update it in place, rather than making new panes on every render
+        self.map_3D = pn.pane.PNG()
+        self.terrain_3D = pn.pane.Plotly(width=600, height=500)
+        self.isolines_map = pn.pane.PNG()
+
+        # The two 3D views, made once for the whole session so switching modes does not add new watchers
+        # (each view's method skips drawing while the other mode is shown, as a hidden view keeps its watchers)
+        self.map_3D_view = pn.panel(self.update_map, lazy=True)
+        self.terrain_3D_view = pn.panel(self.update_terrain_mesh, lazy=True)
+
+    # Release the rendered images and mesh when the session ends (the renders stay in the shared cache)
+    def release(self):
+        for pane in [self.map_3D, self.terrain_3D, self.isolines_map]:
+            pane.object = None
+
     # @param.depends("continent", watch=True)
     # def update_slider_bounds(self):
         # Update slider bounds when the continent changes
@@ -80,12 +125,8 @@ class EarthDisplacement(param.Parameterized):
     # Create a relationship to reset pan values
     @param.depends("continent", watch=True)
     def reset_pan_values(self):
-        # Reset the zoom values to 0 when the continent changes
-        self.param.set_param(region_width=100)
-        self.param.set_param(region_length=100)
-        # Reset pan values to 0 when the continent changes
-        self.param.set_param(pan_longitude=0) 
-        self.param.set_param(pan_latitude=0)
+        # Reset the zoom values to 100 and the pan values to 0 when the continent changes
+        self.param.update(region_width=100, region_length=100, pan_longitude=0, pan_latitude=0)
 
     # Updates the region for the maps depending on the slider values
     def update_region(self):
@@ -119,107 +160,244 @@ class EarthDisplacement(param.Parameterized):
 
         return region
 
+    # The area containing every region the zoom and pan sliders can reach for the continent, which is loaded once
+    def grid_extent(self):
+        box = boxes[self.continent]
+        pan_longitude = max(abs(bound) for bound in self.param.pan_longitude.bounds)
+        pan_latitude = max(abs(bound) for bound in self.param.pan_latitude.bounds)
+
+        west = box["longmin"] - pan_longitude
+        east = box["longmax"] + pan_longitude
+        # Load every longitude once the pan range goes all the way round the globe
+        if east - west >= 360:
+            west, east = -180, 180
+
+        return [west, east, max(box["latmin"] - pan_latitude, -90), min(box["latmax"] + pan_latitude, 90)]
+
     # Create a relationship to update the 3D perspective map
-    @param.depends("continent", "region_width", "region_length", "pan_longitude", "pan_latitude", "isolines", "colour_map", "resolution", watch=True)
+    @param.depends("continent", "region_width", "region_length", "pan_longitude", "pan_latitude", "isolines", "colour_map", "resolution", "terrain_mode")
     def update_map(self):
-        # Create a figure
-        fig = pygmt.Figure()
+        # Keep the last render without drawing while the WebGL mode is shown
+        if self.terrain_mode != "GMT":
+            return self.map_3D
 
         # Calculate the region
         region = self.update_region()
 
-        # Define the 3D perspective map grid
-        # Different reolutions e.g. 01d
-        grid = pygmt.datasets.load_earth_relief(resolution=self.resolution, region=region)
-
-        # Add the colourmap for the 3D perspective
-        fig.grdview(
-            grid=grid,
-            perspective=[-130, 30],
-            frame=["xaf", "yaf", "WSnE"],
-            projection="M15c",
-            zsize="1.5c",
-            surftype="s",
-            cmap=self.colour_map,
-            plane="1000+ggrey",
-        )
+        # Draw the 3D perspective map (only called when these settings are not already in the render cache)
+        def draw():
+            # Create a figure
+            fig = pygmt.Figure()
+
+            # Define the 3D perspective map grid
+            # Different reolutions e.g. 01d
+            grid = shared_cache.load_grid("scientific", "earth_relief", self.resolution, region, self.grid_extent())
+
+            # Add the colourmap for the 3D perspective
+            fig.grdview(
+                grid=grid,
+                perspective=perspective,
+                frame=["xaf", "yaf", "WSnE"],
+                projection="M15c",
+                zsize="1.5c",
+                surftype="s",
+                cmap=self.colour_map,
+                plane="1000+ggrey",
+            )
+
+            # Define the colourbar for the map
+            fig.colorbar(perspective=True, frame=["a2500", "x+lElevation", "y+lm"])
 
-        # Define the colourbar for the map
-        fig.colorbar(perspective=True, frame=["a2500", "x+lElevation", "y+lm"])
+            return fig
 
         # Display the figure
-        return fig
+        self.map_3D.object = shared_cache.render("scientific", ("3D", self.resolution, tuple(region), self.colour_map), draw)
+        return self.map_3D
     
+    # Create a relationship to update the WebGL 3D map, which is only re-sent when the region or resolution change
+    # (rotation, tilt and vertical exaggeration all happen in the browser)
+    @param.depends("continent", "region_width", "region_length", "pan_longitude", "pan_latitude", "resolution", "terrain_mode")
+    def update_terrain_mesh(self):
+        # Keep the last mesh without building or sending a new one while the GMT mode is shown
+        if self.terrain_mode != "WebGL":
+            return self.terrain_3D
+
+        # Calculate the region
+        region = self.update_region()
+
+        # Decimate the grid into a compact mesh (float32 coordinates and int16 elevations in metres)
+        def build_mesh():
+            grid = shared_cache.load_grid("scientific", "earth_relief", self.resolution, region, self.grid_extent())
+            step = max(1, int(np.ceil(max(grid.shape) / mesh_max_points)))
+            decimated = grid[::step, ::step]
+            return {
+                "lon": decimated.lon.values.astype(np.float32),
+                "lat": decimated.lat.values.astype(np.float32),
+                "elevation": np.clip(np.round(np.nan_to_num(decimated.values)), -32768, 32767).astype(np.int16),
+            }
+
+        mesh = shared_cache.cache.get_or_create(
+            "scientific",
+            "mesh",
+            (self.resolution, tuple(region)),
+            build_mesh,
+            lambda mesh: sum(values.nbytes for values in mesh.values()),
+        )
+
+        # Place the camera at the same azimuth and elevation as the GMT perspective
+        azimuth, elevation = np.radians(perspective)
+        eye = {
+            "x": float(2 * np.sin(azimuth) * np.cos(elevation)),
+            "y": float(2 * np.cos(azimuth) * np.cos(elevation)),
+            "z": float(2 * np.sin(elevation)),
+        }
+
+        # Keep the map's longitude and latitude proportions, with a flat base height for the elevations
+        # (the zoom sliders go down to 0%, so the width and length can both be zero)
+        width = max(float(region[1] - region[0]), 1e-6)
+        length = max(float(region[3] - region[2]), 1e-6)
+        base_height = 0.2
+
+        # Vertical exaggeration slider, which only changes the plot's aspect ratio in the browser
+        exaggerations = [0.5, 1, 2, 3, 5, 10]
+        exaggeration_slider = {
+            "active": 1,
+            "currentvalue": {"prefix": "Vertical Exaggeration: "},
+            "pad": {"t": 10},
+            "steps": [
+                {"label": f"{value:g}x", "method": "relayout", "args": [{"scene.aspectratio.z": base_height * value}]}
+                for value in exaggerations
+            ],
+        }
+
+        figure = {
+            "data": [
+                {
+                    "type": "surface",
+                    "x": mesh["lon"],
+                    "y": mesh["lat"],
+                    "z": mesh["elevation"],
+                    "colorscale": plotly_colour_scales[self.colour_map],
+                    "colorbar": {"title": {"text": "Elevation (m)"}},
+                }
+            ],
+            "layout": {
+                "scene": {
+                    "aspectmode": "manual",
+                    "aspectratio": {"x": 1, "y": min(max(length / width, 0.1), 10), "z": base_height},
+                    "camera": {"eye": eye},
+                    "xaxis": {"title": {"text": "Longitude"}},
+                    "yaxis": {"title": {"text": "Latitude"}},
+                    "zaxis": {"title": {"text": "Elevation (m)"}},
+                },
+                "sliders": [exaggeration_slider],
+                "margin": {"l": 0, "r": 0, "t": 0, "b": 0},
+                # Keep the user's camera and exaggeration when the figure is updated
+                "uirevision": "terrain",
+            },
+        }
+
+        # Display the figure
+        self.terrain_3D.object = figure
+        return self.terrain_3D
+
+    # Create a relationship to change only the WebGL 3D map's colours, without re-sending its mesh
+    @param.depends("colour_map", watch=True)
+    def update_terrain_colours(self):
+        figure = self.terrain_3D.object
+        if figure is not None:
+            figure["data"][0]["colorscale"] = plotly_colour_scales[self.colour_map]
+            self.terrain_3D.param.trigger("object")
+
+    # Create a relationship to switch between the GMT and WebGL 3D maps
+    @param.depends("terrain_mode")
+    def update_3D_view(self):
+        if self.terrain_mode == "WebGL":
+            return self.terrain_3D_view
+        return self.map_3D_view
+
     # Create a relationship to update the 2D isolines map
     @param.depends("continent", "region_width", "region_length", "pan_longitude", "pan_latitude", "isolines", "colour_map", "resolution", watch=True)
     def update_isolines_map(self):
-        # Create a figure
-        fig2 = pygmt.Figure()
-
         # Calculate the region
         region = self.update_region()
 
-        # Different resolutions e.g. 01d
-        grid = pygmt.datasets.load_earth_relief(resolution=self.resolution, region=region)
+        # Draw the 2D isolines map (only called when these settings are not already in the render cache)
+        def draw():
+            # Create a figure
+            fig2 = pygmt.Figure()
 
-        # fig2.image(imagefile="colour_dataset\8081_earthmap2k.jpg", region=region, projection="R12c", position="jBR+w14c")
+            # Different resolutions e.g. 01d
+            grid = shared_cache.load_grid("scientific", "earth_relief", self.resolution, region, self.grid_extent())
 
-        # Add the colourmap for the 2D perspective
-        fig2.grdimage(
-            grid=grid,
-            projection="R12c",
-            cmap=self.colour_map,
-        )
-        
-        # Add the isolines for the 2D perspective
-        fig2.grdcontour(
-            annotation=1000,
-            interval=self.isolines,
-            grid=grid,
-            projection="R12c",
-        )
+            # fig2.image(imagefile="colour_dataset\8081_earthmap2k.jpg", region=region, projection="R12c", position="jBR+w14c")
 
-        # Define the colourbar for the map
-        fig2.colorbar(frame=["a2500", "x+lElevation", "y+lm"])
+            # Add the colourmap for the 2D perspective
+            fig2.grdimage(
+                grid=grid,
+                projection="R12c",
+                cmap=self.colour_map,
+            )
+            
+            # Add the isolines for the 2D perspective
+            fig2.grdcontour(
+                annotation=1000,
+                interval=self.isolines,
+                grid=grid,
+                projection="R12c",
+            )
+
+            # Define the colourbar for the map
+            fig2.colorbar(frame=["a2500", "x+lElevation", "y+lm"])
+
+            return fig2
 
         # Display the figure
-        return fig2
+        self.isolines_map.object = shared_cache.render("scientific", ("2D", self.resolution, tuple(region), self.colour_map, self.isolines), draw)
+        return self.isolines_map
     
-# Variable for the class we created
-earth_displacement = EarthDisplacement()
-
-# Define the Panel app and its contents
-app = pn.Column(
-    # Display the header
-    "## Greenpeace Scientific Visualisation",
-    pn.Spacer(height=20),
-
-    # Display all widgets
-    pn.Row(
-        pn.Param(
-            earth_displacement.param,
-            widgets={
-                "continent": {"widget_type": pn.widgets.Select, "width": 175},
-                "region_width": {"widget_type": pn.widgets.FloatSlider, "width": 175},
-                "region_length": {"widget_type": pn.widgets.FloatSlider, "width": 175},
-                "pan_longitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
-                "pan_latitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
-                "isolines": {"widget_type": pn.widgets.IntSlider, "width": 175},
-                "colour_map": {"widget_type": pn.widgets.Select, "width": 175},
-                "resolution": {"widget_type": pn.widgets.Select, "width": 175},
-            },
+# Create a new app for each session, so every user has their own widget values
+def create_app():
+    # Variable for the class we created
+    earth_displacement = EarthDisplacement()
+
+    # Define the Panel app and its contents
+    app = pn.Column(
+        # Display the header
+        "## Greenpeace Scientific Visualisation",
+        pn.Spacer(height=20),
+
+        # Display all widgets
+        pn.Row(
+            pn.Param(
+                earth_displacement.param,
+                widgets={
+                    "continent": {"widget_type": pn.widgets.Select, "width": 175},
+                    "region_width": {"widget_type": pn.widgets.FloatSlider, "width": 175},
+                    "region_length": {"widget_type": pn.widgets.FloatSlider, "width": 175},
+                    "pan_longitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
+                    "pan_latitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
+                    "isolines": {"widget_type": pn.widgets.IntSlider, "width": 175},
+                    "colour_map": {"widget_type": pn.widgets.Select, "width": 175},
+                    "resolution": {"widget_type": pn.widgets.Select, "width": 175},
+                    "terrain_mode": {"widget_type": pn.widgets.Select, "width": 175},
+                },
+            ),
+
+            # Constantly update the 3D map (server rendered or WebGL)
+            earth_displacement.update_3D_view,
+
+            # Constantly update the 2D map
+            pn.panel(earth_displacement.update_isolines_map, sizing_mode="fixed", height=260, width=389),
         ),
+    )
 
-        # Constantly update the 3D map
-        earth_displacement.update_map,
-
-        # Constantly update the 2D map
-        pn.panel(earth_displacement.update_isolines_map, sizing_mode="fixed", height=260, width=389),
-    ),
-)
+    # Release the session's panes when its browser tab is closed
+    if pn.state.curdoc is not None:
+        pn.state.curdoc.on_session_destroyed(lambda session_context: earth_displacement.release())
 
-# Check for when the continent changes to then reset the pan values
-earth_displacement.param.watch(earth_displacement.reset_pan_values, "continent")
+    return app
 
-# Run the app
-pn.serve(app, show=True)
\ No newline at end of file
+# Run the app on its own (serve_all.py serves it together with the public app)
+if __name__ == "__main__":
+    pn.serve(create_app, show=True, **lifecycle.serve_options)
@@ -2,6 +2,9 @@ import panel as pn
 import pygmt
 import param
 
+import lifecycle
+import shared_cache
+
 # Load a panel template
 pn.config.template = "fast"
 
@@ -30,9 +33,29 @@ class EarthDisplacement(param.Parameterized):
     # Dropdown menus for the colour map and colour bar
     colour_map = param.ObjectSelector(default="geo", objects=["geo", "viridis", "ocean"], label="Colour Map")
 
-    # Text sections for the two maps
-    text_3D = pn.pane.Markdown(width=400)
-    text_2D = pn.pane.Markdown(width=400)
+    def __init__(self, **params):
+        super().__init__(**params)
+
+        # Keep one pane for each map and text section and update them in place, rather than making new panes on every render
+        self.globe = pn.pane.PNG()
+        self.isolines_map = pn.pane.PNG()
+
+        # Text sections for the two maps
+        self.text_3D = pn.pane.Markdown(width=400)
+        self.text_2D = pn.pane.Markdown(width=400)
+
+        # The layouts for the two maps, made once for the whole session
+        self.globe_view = pn.Column(self.globe, self.text_3D)
+        self.isolines_view = pn.Column(self.isolines_map, self.text_2D)
+
+        # Draw the maps for the starting widget values
+        self.update_globe()
+        self.update_isolines_map()
+
+    # Release the rendered images and text when the session ends (the renders stay in the shared cache)
+    def release(self):
+        for pane in [self.globe, self.isolines_map, self.text_3D, self.text_2D]:
+            pane.object = None
 
     # @param.depends("continent", watch=True)
     # def update_slider_bounds(self):
@@ -81,45 +104,55 @@ class EarthDisplacement(param.Parameterized):
     # Create a relationship to update the 2D isolines map
     @param.depends("pan_longitude", "pan_latitude", "isolines", "colour_map", watch=True)
     def update_globe(self):
-        # Create a figure
-        fig = pygmt.Figure()
+        # Draw the globe (only called when these settings are not already in the render cache)
+        def draw():
+            # Create a figure
+            fig = pygmt.Figure()
+
+            # Update the region based on the selected longitude and latitude 
+            region = [-180, 180, -90, 90]
+
+            # Ensure the second set of data is loaded if the ocean colourmap is selected
+            if self.colour_map == "ocean":
+                grid = shared_cache.load_grid("public", "earth_geoid", "01d", region)
+            else:
+                grid = shared_cache.load_grid("public", "earth_relief", "01d", region)
+
+            # Add the colourmap for the globe perspective
+            fig.grdimage(
+                grid=grid,
+                projection=f"G{self.pan_longitude}/{self.pan_latitude}/12c",
+                cmap=self.colour_map,
+            )
+            
+            # Add the isolines for the globe perspective
+            fig.grdcontour(
+                annotation=1000,
+                interval=self.isolines,
+                grid=grid,
+                projection=f"G{self.pan_longitude}/{self.pan_latitude}/12c",
+            )
 
-        # Update the region based on the selected longitude and latitude 
-        region = [-180, 180, -90, 90]
+            # Add text annotations for each continent
+            for continent, coords in continents.items():
+                lon, lat = (coords[0] + coords[1]) / 2, (coords[2] + coords[3]) / 2
+                # Define the text and its positions
+                fig.text(
+                    x=lon,
+                    y=lat,
+                    text=continent,
+                    justify="CM",
+                    offset="0p/5p",
+                    font="20p,Helvetica-Bold,white",
+                )
 
-        # Ensure the second set of data is loaded if the ocean colourmap is selected
-        if self.colour_map == "ocean":
-            grid = pygmt.datasets.load_earth_geoid(resolution="01d", region=region)
-        else:
-            grid = pygmt.datasets.load_earth_relief(resolution="01d", region=region)
-
-        # Add the colourmap for the globe perspective
-        fig.grdimage(
-            grid=grid,
-            projection=f"G{self.pan_longitude}/{self.pan_latitude}/12c",
-            cmap=self.colour_map,
-        )
-        
-        # Add the isolines for the globe perspective
-        fig.grdcontour(
-            annotation=1000,
-            interval=self.isolines,
-            grid=grid,
-            projection=f"G{self.pan_longitude}/{self.pan_latitude}/12c",
-        )
-
-        # Add text annotations for each continent
-        for continent, coords in continents.items():
-            lon, lat = (coords[0] + coords[1]) / 2, (coords[2] + coords[3]) / 2
-            # Define the text and its positions
-            fig.text(
-                x=lon,
-                y=lat,
-                text=continent,
-                justify="CM",
-                offset="0p/5p",
-                font="20p,Helvetica-Bold,white",
-            )
+            # Define the colourbar for the map
+            fig.colorbar(frame=["a2500", "x+lElevation", "y+lm"])
+
+            return fig
+
+        # Render the globe, reusing the cached render if these settings were drawn before
+        self.globe.object = shared_cache.render("public", ("globe", self.pan_longitude, self.pan_latitude, self.isolines, self.colour_map), draw)
 
         # Text to display if "geo" is chosen
         if self.colour_map == "geo":
@@ -246,41 +279,46 @@ class EarthDisplacement(param.Parameterized):
             <h3>References</h3>
             <p>"Climate Change. United Nations. Available at: "<a href="https://www.un.org/en/climatechange">Climate Change - United Nations</a></p>
             """
-        
-        # Define the colourbar for the map
-        fig.colorbar(frame=["a2500", "x+lElevation", "y+lm"])
 
         # Display the figure
-        return pn.Column(fig, self.text_3D)
+        return self.globe_view
     
     # Create a relationship to update the 2D isolines map
     @param.depends("continent", "isolines", "colour_map", watch=True)
     def update_isolines_map(self):
-        # Create a figure
-        fig2 = pygmt.Figure()
-
         # Adjust the region based on the continent selected
         region = continents[self.continent]
 
-        # Different resolutions e.g. 01d
-        grid = pygmt.datasets.load_earth_relief(resolution="01d", region=region)
+        # Draw the 2D isolines map (only called when these settings are not already in the render cache)
+        def draw():
+            # Create a figure
+            fig2 = pygmt.Figure()
 
-        # Add the colourmap for the 2D perspective
-        fig2.grdimage(
-            grid=grid,
-            projection="R12c",
-            cmap=self.colour_map,
-        )
-        
-        # Add the isolines for the 2D perspective
-        fig2.grdcontour(
-            annotation=1000,
-            interval=self.isolines,
-            grid=grid,
-            projection="R12c",
-        )
+            # Different resolutions e.g. 01d
+            # (cropped from the whole globe, which the globe view also uses)
+            grid = shared_cache.load_grid("public", "earth_relief", "01d", region, [-180, 180, -90, 90])
+
+            # Add the colourmap for the 2D perspective
+            fig2.grdimage(
+                grid=grid,
+                projection="R12c",
+                cmap=self.colour_map,
+            )
+            
+            # Add the isolines for the 2D perspective
+            fig2.grdcontour(
+                annotation=1000,
+                interval=self.isolines,
+                grid=grid,
+                projection="R12c",
+            )
+
+            # fig2.colorbar(frame=["a2500", "x+lElevation", "y+lm"])
+
+            return fig2
 
-        # fig2.colorbar(frame=["a2500", "x+lElevation", "y+lm"])
+        # Render the map, reusing the cached render if these settings were drawn before
+        self.isolines_map.object = shared_cache.render("public", ("2D", self.continent, self.isolines, self.colour_map), draw)
 
         # Text to display if "Europe" is chosen
         if self.continent == "Europe":
@@ -449,38 +487,47 @@ class EarthDisplacement(param.Parameterized):
             """  
 
         # Display the figure
-        return pn.Column(fig2, self.text_2D)
+        return self.isolines_view
     
-# Variable for the class we created
-earth_displacement = EarthDisplacement()
-
-# tabs = pn.Tabs(("Global View", earth_displacement.update_globe), 
-#                ("Regional View", pn.panel(earth_displacement.update_isolines_map, sizing_mode="stretch_both")))
-
-# Define the Panel app and its contents
-app = pn.Column(
-    # Define the header
-    "## Greenpeace Public Interactive Visualisation",
-    pn.Spacer(height=20),
-    pn.Row(
-
-        # Display all the widgets
-        pn.Param(
-            earth_displacement.param,
-            widgets={
-                "continent": {"widget_type": pn.widgets.Select, "width": 175},
-                "pan_longitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
-                "pan_latitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
-                "isolines": {"widget_type": pn.widgets.IntSlider, "width": 175},
-                "colour_map": {"widget_type": pn.widgets.Select, "width": 175},
-            },
-        ),
-
-    # Constantly update the globe
-    earth_displacement.update_globe,
-    # Ensure the isolines map is sized correctly and update it
-    pn.panel(earth_displacement.update_isolines_map, sizing_mode="fixed", height=260, width=389)),
-)
-
-# Run the app
-pn.serve(app, show=True)
\ No newline at end of file
+# Create a new app for each session, so every user has their own widget values
+def create_app():
+    # Variable for the class we created
+    earth_displacement = EarthDisplacement()
+
+    # tabs = pn.Tabs(("Global View", earth_displacement.update_globe), 
+    #                ("Regional View", pn.panel(earth_displacement.update_isolines_map, sizing_mode="stretch_both")))
+
+    # Define the Panel app and its contents
+    app = pn.Column(
+        # Define the header
+        "## Greenpeace Public Interactive Visualisation",
+        pn.Spacer(height=20),
+        pn.Row(
+
+            # Display all the widgets
+            pn.Param(
+                earth_displacement.param,
+                widgets={
+                    "continent": {"widget_type": pn.widgets.Select, "width": 175},
+                    "pan_longitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
+                    "pan_latitude": {"widget_type": pn.widgets.FloatSlider, "width": 175},
+                    "isolines": {"widget_type": pn.widgets.IntSlider, "width": 175},
+                    "colour_map": {"widget_type": pn.widgets.Select, "width": 175},
+                },
+            ),
+
+        # Display the globe (updated in place whenever the widgets change)
+        earth_displacement.globe_view,
+        # Ensure the isolines map is sized correctly (also updated in place)
+        pn.Column(earth_displacement.isolines_view, sizing_mode="fixed", height=260, width=389)),
+    )
+
+    # Release the session's panes when its browser tab is closed
+    if pn.state.curdoc is not None:
+        pn.state.curdoc.on_session_destroyed(lambda session_context: earth_displacement.release())
+
+    return app
+
+# Run the app on its own (serve_all.py serves it together with the scientific app)
+if __name__ == "__main__":
+    pn.serve(create_app, show=True, **lifecycle.serve_options)
@@ -0,0 +1,64 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+from pygmt.session_management import begin, end
+
+# GMT is not thread safe, so every grid load and render in this process goes through one lock
+gmt_lock = threading.RLock()
+
+# The number of renders after which the GMT session (and the files GMT keeps for every figure in it) is restarted
+SESSION_RENDER_LIMIT = int(os.environ.get("VIS_SESSION_RENDER_LIMIT", 200))
+
+# Options for pn.serve (passed on to Bokeh's server) to check for sessions left by closed browser tabs every 5 seconds,
+# rather than Bokeh's default of 17 seconds, and destroy them once they have been unused for 15 seconds
+serve_options = {"check_unused_sessions_milliseconds": 5000, "unused_session_lifetime_milliseconds": 15000}
+
+# A private temporary folder for encoding figures, removed when the process exits
+render_dir = tempfile.mkdtemp(prefix="vis-render-")
+atexit.register(shutil.rmtree, render_dir, ignore_errors=True)
+
+# Variable for the number of renders in the current GMT session
+renders = 0
+
+# Encode a figure to PNG bytes and remove every file made for it, so only the bytes are kept
+def encode_figure(fig):
+    global renders
+
+    path = os.path.join(render_dir, f"{uuid.uuid4().hex}.png")
+    try:
+        # Use the same resolution Panel used when displaying the figures directly
+        fig.savefig(path, dpi=70, anti_alias=True)
+        with open(path, "rb") as file:
+            png = file.read()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        # Each figure also makes its own preview folder, which would otherwise stay until the figure is garbage collected
+        preview_dir = getattr(fig, "_preview_dir", None)
+        if preview_dir is not None:
+            preview_dir.cleanup()
+
+    # Restart the GMT session every so often, as GMT only removes a session's figure files when it ends
+    renders += 1
+    if renders >= SESSION_RENDER_LIMIT:
+        restart_gmt_session()
+
+    return png
+
+# Draw a figure and encode it, holding the GMT lock throughout
+def render_png(draw):
+    with gmt_lock:
+        return encode_figure(draw())
+
+# End the GMT session and begin a new one
+def restart_gmt_session():
+    global renders
+
+    with gmt_lock:
+        end()
+        begin()
+        renders = 0
@@ -0,0 +1,34 @@
+import importlib
+
+import panel as pn
+
+import lifecycle
+import shared_cache
+
+# The app files start with a digit, so they are imported by name rather than with an import statement
+scientific = importlib.import_module("1_scientific")
+public = importlib.import_module("2_public")
+
+# Create a page showing how much of the shared memory budget each app is using
+def create_usage_page():
+    usage = pn.pane.Markdown(shared_cache.usage_report())
+
+    # Refresh the report every five seconds
+    def refresh():
+        usage.object = shared_cache.usage_report()
+
+    pn.state.add_periodic_callback(refresh, period=5000)
+
+    return pn.Column("## Shared Cache Usage", usage)
+
+# Serve both apps (and the usage page) from one server, so they share one grid cache and one render cache
+if __name__ == "__main__":
+    pn.serve(
+        {
+            "scientific": scientific.create_app,
+            "public": public.create_app,
+            "usage": create_usage_page,
+        },
+        show=True,
+        **lifecycle.serve_options,
+    )
@@ -0,0 +1,162 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pygmt
+
+import lifecycle
+
+# The global memory budget (in MB) shared by every app served from this process
+MEMORY_BUDGET_MB = float(os.environ.get("VIS_MEMORY_BUDGET_MB", 512))
+
+# The datasets the apps are able to load, by name
+loaders = {
+    "earth_relief": pygmt.datasets.load_earth_relief,
+    "earth_geoid": pygmt.datasets.load_earth_geoid,
+}
+
+# Define a least recently used cache which keeps all of its entries under one memory budget
+class SharedCache:
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    # Return the cached value for the key, or create, measure and store it
+    def get_or_create(self, app, kind, key, create, sizeof):
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry is not None:
+                # Mark the entry as the most recently used and record which app asked for it
+                self.entries.move_to_end((kind, key))
+                entry["apps"].add(app)
+                return entry["value"]
+
+        # Create the value outside the lock so one slow render does not block the other sessions
+        value = create()
+        nbytes = sizeof(value)
+
+        with self.lock:
+            # Another session may have created the same value in the meantime
+            entry = self.entries.get((kind, key))
+            if entry is not None:
+                entry["apps"].add(app)
+                return entry["value"]
+
+            # Values larger than the whole budget are returned but never stored
+            if nbytes > self.budget_bytes:
+                return value
+
+            self.entries[(kind, key)] = {"value": value, "nbytes": nbytes, "apps": {app}}
+            self.total_bytes += nbytes
+
+            # Evict the least recently used entries until the cache is back under the budget
+            while self.total_bytes > self.budget_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted["nbytes"]
+                self.evictions += 1
+
+        return value
+
+    # Return the most recently used value of this kind whose key passes match(key), or None
+    def find(self, app, kind, match):
+        with self.lock:
+            for (entry_kind, key), entry in reversed(self.entries.items()):
+                if entry_kind == kind and match(key):
+                    self.entries.move_to_end((entry_kind, key))
+                    entry["apps"].add(app)
+                    return entry["value"]
+        return None
+
+    # Remove every entry from the cache
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    # Summarise the memory used by each app and kind of entry (shared entries count towards every app using them)
+    def usage(self):
+        with self.lock:
+            apps = {}
+            for (kind, _), entry in self.entries.items():
+                for app in entry["apps"]:
+                    app_usage = apps.setdefault(app, {})
+                    kind_usage = app_usage.setdefault(kind, {"entries": 0, "bytes": 0})
+                    kind_usage["entries"] += 1
+                    kind_usage["bytes"] += entry["nbytes"]
+            return {
+                "apps": apps,
+                "total_bytes": self.total_bytes,
+                "budget_bytes": self.budget_bytes,
+                "entries": len(self.entries),
+                "evictions": self.evictions,
+            }
+
+# Variable for the cache shared by every app in this process
+cache = SharedCache(int(MEMORY_BUDGET_MB * 1024 * 1024))
+
+# Check whether the first region (West, East, South and North) contains the second
+# (a grid spanning all 360 degrees of longitude contains every longitude)
+def covers(outer, inner):
+    contains_lon = outer[1] - outer[0] >= 360 or (outer[0] <= inner[0] and outer[1] >= inner[1])
+    return contains_lon and outer[2] <= inner[2] and outer[3] >= inner[3]
+
+# Cut a region out of a grid, wrapping the longitudes around when the region crosses the grid's edge
+def crop(grid, region):
+    west, east, south, north = region
+    lon = grid.lon.values
+    if west < lon.min() or east > lon.max():
+        # Move the longitudes into the 360 degrees starting at the region's west edge, dropping the repeated column
+        wrapped = (lon - west) % 360 + west
+        _, columns = np.unique(wrapped, return_index=True)
+        grid = grid.isel(lon=columns).assign_coords(lon=wrapped[columns])
+    return grid.sel(lon=slice(west, east), lat=slice(south, north))
+
+# Load a grid for the region, caching the whole extent (e.g. everywhere the pan sliders can reach) once for all apps
+# so that each pan or zoom step is a crop of the same cached grid rather than a new copy
+def load_grid(app, dataset, resolution, region, extent=None):
+    region = tuple(float(value) for value in region)
+    extent = tuple(float(value) for value in extent) if extent is not None else region
+
+    # Reuse any cached grid of the same dataset and resolution which covers the region (e.g. the globe's grid for the world map)
+    grid = cache.find(app, "grid", lambda cached: cached[:2] == (dataset, resolution) and covers(cached[2], region))
+    if grid is None:
+        grid = cache.get_or_create(
+            app,
+            "grid",
+            (dataset, resolution, extent),
+            lambda: load_with_lock(dataset, resolution, extent),
+            lambda grid: grid.nbytes,
+        )
+
+    return crop(grid, region)
+
+# Load a grid while holding the GMT lock
+def load_with_lock(dataset, resolution, region):
+    with lifecycle.gmt_lock:
+        return loaders[dataset](resolution=resolution, region=list(region))
+
+# Render a figure once to PNG bytes, only calling draw() when the key is not already cached
+def render(app, key, draw):
+    return cache.get_or_create(app, "render", (app,) + tuple(key), lambda: lifecycle.render_png(draw), len)
+
+# Create a markdown table of the cache usage for each app
+def usage_report():
+    usage = cache.usage()
+    megabyte = 1024 * 1024
+
+    lines = [
+        f"Total: {usage['total_bytes'] / megabyte:.1f} MB of {usage['budget_bytes'] / megabyte:.0f} MB "
+        f"({usage['entries']} entries, {usage['evictions']} evictions)",
+        "",
+        "| App | Kind | Entries | Memory (MB) |",
+        "| --- | --- | --- | --- |",
+    ]
+    for app, kinds in sorted(usage["apps"].items()):
+        for kind, kind_usage in sorted(kinds.items()):
+            lines.append(f"| {app} | {kind} | {kind_usage['entries']} | {kind_usage['bytes'] / megabyte:.1f} |")
+
+    return "\n".join(lines)
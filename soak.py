@@ -0,0 +1,170 @@
+import argparse
+import gc
+import importlib
+import os
+import random
+import tempfile
+import types
+
+# Use a small cache budget and frequent GMT session restarts, so eviction and cleanup both happen many times during the soak
+os.environ.setdefault("VIS_MEMORY_BUDGET_MB", "64")
+os.environ.setdefault("VIS_SESSION_RENDER_LIMIT", "50")
+
+import numpy as np
+import panel as pn
+import param
+import xarray as xr
+from bokeh.document import Document
+from panel.io.state import set_curdoc
+from pygmt.exceptions import GMTError
+
+import lifecycle
+import shared_cache
+
+# The app files start with a digit, so they are imported by name rather than with an import statement
+scientific = importlib.import_module("1_scientific")
+public = importlib.import_module("2_public")
+
+# The grid spacing in degrees for each resolution (only the coarse ones are used, to keep the soak quick)
+resolutions = {"01d": 1, "30m": 1 / 2, "20m": 1 / 3, "15m": 1 / 4, "10m": 1 / 6}
+
+# Make a synthetic relief grid for the region, so the soak does not download any data
+def synthetic_grid(resolution, region):
+    spacing = resolutions[resolution]
+    lon = np.arange(region[0], region[1] + spacing / 2, spacing)
+    lat = np.arange(region[2], region[3] + spacing / 2, spacing)
+    elevation = 4000 * np.sin(np.radians(lat))[:, None] * np.cos(np.radians(2 * lon))[None, :]
+    return xr.DataArray(elevation.astype(np.float32), coords={"lat": lat, "lon": lon}, dims=("lat", "lon"))
+
+# Choose a random value for a parameter, within its objects or bounds
+def random_value(rng, parameter):
+    if isinstance(parameter, param.Selector):
+        objects = [value for value in parameter.objects if value in resolutions] if parameter.name == "resolution" else parameter.objects
+        return rng.choice(list(objects))
+    low, high = parameter.bounds
+    step = parameter.step or 1
+    return low + step * rng.randint(0, int((high - low) / step))
+
+# The resident memory of this process in bytes (read from /proc, so the soak needs Linux)
+def rss_bytes():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+# The number of files made by the apps' renders: in the render folder, GMT's session folder and pygmt's temporary files
+def temp_file_count():
+    folders = [lifecycle.render_dir, os.environ.get("GMT_TMPDIR", os.path.join(os.path.expanduser("~"), ".gmt", "sessions"))]
+
+    # pygmt names its temporary files "pygmt-..." and each figure's preview folder "<figure name>-preview-..."
+    temp_dir = tempfile.gettempdir()
+    folders += [
+        os.path.join(temp_dir, name) for name in os.listdir(temp_dir) if name.startswith("pygmt-") or "-preview-" in name
+    ]
+
+    count = 0
+    for folder in folders:
+        if os.path.isfile(folder):
+            count += 1
+        for _, _, files in os.walk(folder):
+            count += len(files)
+    return count
+
+# Open a session like pn.serve does: build the app and render it into its own document
+def open_session(create_app):
+    doc = Document()
+    with set_curdoc(doc):
+        app = create_app()
+        app.server_doc(doc)
+
+    # The widgets change the app's EarthDisplacement object, found through its parameter pane
+    earth_displacement = app.select(pn.Param)[0].object
+    return doc, earth_displacement
+
+# Close a session like Bokeh does when its browser tab is closed, running the session destroyed callbacks
+def close_session(doc):
+    session_context = types.SimpleNamespace(id=str(id(doc)), _document=doc)
+    callbacks = doc.session_destroyed_callbacks
+    doc.session_destroyed_callbacks = set()
+    with set_curdoc(doc):
+        for callback in callbacks:
+            callback(session_context)
+    doc.clear()
+
+# Change one random widget, like a user would (Panel then redraws whatever is displayed)
+def interact(rng, session):
+    doc, earth_displacement = session
+    names = [name for name in earth_displacement.param.objects() if name != "name"]
+    name = rng.choice(names)
+    with set_curdoc(doc):
+        earth_displacement.param.update(**{name: random_value(rng, earth_displacement.param[name])})
+
+# Replay random interactions over many short sessions and check that memory and temporary files plateau
+def soak(interactions, session_length, samples, seed):
+    rng = random.Random(seed)
+    shared_cache.loaders["earth_relief"] = lambda resolution, region: synthetic_grid(resolution, region)
+    shared_cache.loaders["earth_geoid"] = lambda resolution, region: synthetic_grid(resolution, region) / 100
+
+    sample_every = max(1, interactions // samples)
+    rss, temp_files = [], []
+    saturated_at = None
+    sessions = []
+    failures = 0
+
+    for interaction in range(interactions):
+        # Start a new session for each app every so often, closing the old ones
+        if interaction % session_length == 0:
+            for doc, _ in sessions:
+                close_session(doc)
+            sessions = [open_session(scientific.create_app), open_session(public.create_app)]
+            gc.collect()
+
+        # Some widget values fail to draw in the apps too (e.g. panning past the poles), and must not leak either
+        try:
+            interact(rng, rng.choice(sessions))
+        except GMTError:
+            failures += 1
+
+        if interaction % sample_every == 0:
+            # Warming up ends at the first sample where the cache has filled its budget (and so has started evicting)
+            cache = shared_cache.cache
+            if saturated_at is None and (cache.evictions > 0 or cache.total_bytes >= cache.budget_bytes):
+                saturated_at = len(rss)
+
+            rss.append(rss_bytes())
+            temp_files.append(temp_file_count())
+            print(
+                f"{interaction:>6} interactions: {rss[-1] / 1024 / 1024:.1f} MB resident, "
+                f"{temp_files[-1]} temporary files, {shared_cache.cache.total_bytes / 1024 / 1024:.1f} MB cached"
+            )
+
+    # Only the samples after the cache is full can show a plateau, so reject runs too short to fill it
+    if saturated_at is None or len(rss) - saturated_at < 8:
+        raise SystemExit(
+            f"The cache did not fill its {shared_cache.cache.budget_bytes / 1024 / 1024:.0f} MB budget early enough "
+            f"to check for a plateau, so run more interactions than {interactions}"
+        )
+
+    # Compare the peak of the last quarter of the samples after warming up with the peak of the first quarter
+    rss, temp_files = rss[saturated_at:], temp_files[saturated_at:]
+    quarter = len(rss) // 4
+    rss_growth = max(rss[-quarter:]) - max(rss[:quarter])
+    temp_file_growth = max(temp_files[-quarter:]) - max(temp_files[:quarter])
+
+    print(f"Warming up took {saturated_at * sample_every} interactions")
+    print(f"Resident memory growth after warming up: {rss_growth / 1024 / 1024:.1f} MB")
+    print(f"Temporary file growth after warming up: {temp_file_growth}")
+    print(f"Interactions which failed to draw: {failures}")
+    print(shared_cache.usage_report())
+
+    assert rss_growth <= max(0.1 * max(rss[:quarter]), 32 * 1024 * 1024), "Resident memory did not plateau"
+    assert temp_file_growth <= 5, "Temporary files did not plateau"
+
+# Run the soak test from the command line
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay random interactions against both apps using synthetic grids.")
+    parser.add_argument("--interactions", type=int, default=5000, help="Number of widget changes to replay")
+    parser.add_argument("--session-length", type=int, default=50, help="Number of interactions in each session")
+    parser.add_argument("--samples", type=int, default=100, help="Number of memory and temporary file samples")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the interactions")
+    args = parser.parse_args()
+
+    soak(args.interactions, args.session_length, args.samples, args.seed)